@@ -6,52 +6,41 @@ import csp
 # @ stdin: receiving input
 from sys import stderr, stdin
 
-# @ product: creation of the variables' domains
-# @ permutations: determine the satisfiability of an operation
-from itertools import product, permutations
+# @ combinations_with_replacement, permutations: enumeration of the
+# satisfying multisets of a commutative operation and of their orderings
+from itertools import combinations_with_replacement, permutations
 
-# @ reduce: determine the result of an operation
-from functools import reduce
+# @ prod: determine the result of a multiplication operation
+from math import prod
+
+# @ lru_cache: memoization of the per-clique domains
+from functools import lru_cache
 
 # @ seed: seed the pseudorandom number generator
-# @ random, shuffle, randint, choice: generate a random kenken puzzle
-from random import seed, random, shuffle, randint, choice
+# @ randint, choice: generate a random kenken puzzle
+from random import seed, randint, choice
+
+# @ OrderedDict: ordered set of the uncaged cells with O(1) removal
+from collections import OrderedDict
 
 # @ time: benchmarking
 import time
 
+# @ ProcessPoolExecutor: run independent benchmarking tasks on every core
+from concurrent.futures import ProcessPoolExecutor
+
+# @ cpu_count: size the benchmarking process pool
+from os import cpu_count
+
 # @ writer: output benchmarking data in a csv format
 from csv import writer
 import numpy as np
 
-
-def operation(operator):
-    """
-    A utility function used in order to determine the operation corresponding
-    to the operator that is given in string format
-    """
-    if operator == '+':
-        return lambda a, b: a + b
-    elif operator == '-':
-        return lambda a, b: a - b
-    elif operator == '*':
-        return lambda a, b: a * b
-    elif operator == '/':
-        return lambda a, b: a / b
-    else:
-        return None
-
-
-def adjacent(xy1, xy2):
-    """
-    Checks wheither two positions represented in 2D coordinates are adjacent
-    """
-    x1, y1 = xy1
-    x2, y2 = xy2
-
-    dx, dy = x1 - x2, y1 - y2
-
-    return (dx == 0 and abs(dy) == 1) or (dy == 0 and abs(dx) == 1)
+# @ OPERATORS: the operators a clique can carry
+# @ OP_CODE: the integer each operator is encoded as in Kenken's
+#   structure-of-arrays clique layout
+OPERATORS = "+-*/."
+OP_CODE = {operator: code for code, operator in enumerate(OPERATORS)}
 
 
 def generate(size):
@@ -60,14 +49,14 @@ def generate(size):
       * Initially create a latin square of size 'size' and elements the values [1...size]
       * Shuffle the board by rows and columns in order to get a somewhat random
         board that still satisfies the different row-col constraint of kenken
-      * Initialize the 'uncaged' set with all cell coordinates
+      * Collect every cell into the 'uncaged' ordered set, in row major order
       * Proceed in creating cliques:
         * Randomly choose a clique size in the range [1..4]
-        * Set the first cell in the 'uncaged' set in row major order as
-          the root cell of the clique and remove it from the 'uncaged' set
+        * Set the first 'uncaged' cell in row major order as the root
+          cell of the clique and cage it
         * Randomly visit at most 'clique-size' 'uncaged' adjacent cells
           in random directions while adding them to the current clique
-          and removing them from the 'uncaged' cells
+          and caging them
         * The size of the resulting clique is:
           * == 1:
             there is no operation to be performed and the target of the clique
@@ -85,20 +74,16 @@ def generate(size):
           to no clique
     """
 
-    board = [[((i + j) % size) + 1 for i in range(size)] for j in range(size)]
-
-    for _ in range(size):
-        shuffle(board)
+    board = (np.arange(size)[:, None] + np.arange(size)[None, :]) % size + 1
 
-    for c1 in range(size):
-        for c2 in range(size):
-            if random() > 0.5:
-                for r in range(size):
-                    board[r][c1], board[r][c2] = board[r][c2], board[r][c1]
+    board = board[np.random.permutation(size)][:, np.random.permutation(size)]
 
-    board = {(j + 1, i + 1): board[i][j] for i in range(size) for j in range(size)}
+    board = {(j + 1, i + 1): int(board[i][j]) for i in range(size) for j in range(size)}
 
-    uncaged = sorted(board.keys(), key=lambda var: var[1])
+    # The 'uncaged' cells form an ordered set backed by a linked hash map:
+    # the first cell in row major order, arbitrary removals and the
+    # membership probes of the neighbor cells are all O(1)
+    uncaged = OrderedDict.fromkeys((x, y) for y in range(1, size + 1) for x in range(1, size + 1))
 
     cliques = []
     while uncaged:
@@ -107,22 +92,21 @@ def generate(size):
 
         csize = randint(1, 4)
 
-        cell = uncaged[0]
-
-        uncaged.remove(cell)
+        cell, _ = uncaged.popitem(last=False)
 
         cliques[-1].append(cell)
 
         for _ in range(csize - 1):
+            x, y = cell
 
-            adjs = [other for other in uncaged if adjacent(cell, other)]
+            adjs = [adj for adj in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)) if adj in uncaged]
 
             cell = choice(adjs) if adjs else None
 
             if not cell:
                 break
 
-            uncaged.remove(cell)
+            del uncaged[cell]
 
             cliques[-1].append(cell)
 
@@ -133,16 +117,20 @@ def generate(size):
             continue
         elif csize == 2:
             fst, snd = cliques[-1][0], cliques[-1][1]
-            if board[fst] / board[snd] > 0 and not board[fst] % board[snd]:
+            if not board[fst] % board[snd]:
                 operator = "/"  # choice("+-*/")
+                target = board[fst] // board[snd]
             else:
                 operator = "-"  # choice("+-*")
+                target = abs(board[fst] - board[snd])
+        elif choice("+*") == '+':
+            operator = "+"
+            target = sum(board[cell] for cell in cliques[-1])
         else:
-            operator = choice("+*")
-
-        target = reduce(operation(operator), [board[cell] for cell in cliques[-1]])
+            operator = "*"
+            target = prod(board[cell] for cell in cliques[-1])
 
-        cliques[-1] = (tuple(cliques[-1]), operator, int(target))
+        cliques[-1] = (tuple(cliques[-1]), operator, target)
 
     return size, cliques
 
@@ -156,10 +144,16 @@ def validate(size, cliques):
         * Check if any of the members of the clique are out of bounds
         * Check if any member of the clique is mentioned in any other clique
       * Check if the given cliques cover the whole board or not
+
+    Membership bookkeeping lives in a single integer bitset with one bit per
+    cell, so the cross-reference and coverage checks are bitwise operations
+    instead of one set construction per clique plus a board-sized difference
     """
     outOfBounds = lambda xy: xy[0] < 1 or xy[0] > size or xy[1] < 1 or xy[1] > size
 
-    mentioned = set()
+    bit = lambda xy: 1 << ((xy[1] - 1) * size + (xy[0] - 1))
+
+    covered = 0
     for i in range(len(cliques)):
         members, operator, target = cliques[i]
 
@@ -167,7 +161,7 @@ def validate(size, cliques):
 
         members, operator, target = cliques[i]
 
-        if operator not in "+-*/.":
+        if operator not in OPERATORS:
             print("Operation", operator, "of clique", cliques[i], "is unacceptable", file=stderr)
             exit(1)
 
@@ -176,18 +170,19 @@ def validate(size, cliques):
             print("Members", problematic, "of clique", cliques[i], "are out of bounds", file=stderr)
             exit(2)
 
-        problematic = mentioned.intersection(set(members))
+        problematic = [member for member in members if covered & bit(member)]
         if problematic:
             print("Members", problematic, "of clique", cliques[i], "are cross referenced", file=stderr)
             exit(3)
 
-        mentioned.update(set(members))
+        for member in members:
+            covered |= bit(member)
 
-    indexes = range(1, size + 1)
+    if covered != (1 << size * size) - 1:
+        indexes = range(1, size + 1)
 
-    problematic = set([(x, y) for y in indexes for x in indexes]).difference(mentioned)
+        problematic = [(x, y) for y in indexes for x in indexes if not covered & bit((x, y))]
 
-    if problematic:
         print("Positions", problematic, "were not mentioned in any clique", file=stderr)
         exit(4)
 
@@ -222,70 +217,137 @@ def conflicting(A, a, B, b):
     return False
 
 
-def satisfies(values, operation, target):
+def conflict_pairs(A, B):
     """
-    Evaluates to true if the result of applying the operation
-    on a permutation of the given values is equal to the specified target
+    Precompute the pairs of indexes (i, j) for which the i-th member of A
+    and the j-th member of B lie in the same row or the same column, i.e.
+    the only positions that 'conflicting' actually needs to compare.
+    Cliques hold at most a handful of cells, so the resulting tuples are
+    tiny and cheap to iterate at constraint-check time
     """
-    for p in permutations(values):
-        if reduce(operation, p) == target:
-            return True
+    return tuple((i, j) for i in range(len(A)) for j in range(len(B)) if RowXorCol(A[i], B[j]))
 
-    return False
 
+def satisfies(values, operator, target):
+    """
+    Evaluates to true if applying the operation denoted by the given
+    operator on the given values can produce the specified target
 
-def gdomains(size, cliques):
+    Since '+' and '*' are commutative they are checked directly, and since
+    '-' and '/' only ever apply to cliques of two cells, checking the two
+    possible orderings amounts to comparing against the absolute difference
+    or the quotient of the values
     """
-    @ https://docs.python.org/2/library/itertools.html
-    @ product('ABCD', repeat=2) = [AA AB AC AD BA BB BC BD CA CB CC CD DA DB DC DD]
+    if operator == '+':
+        return sum(values) == target
+    elif operator == '*':
+        return prod(values) == target
+    elif operator == '-':
+        return abs(values[0] - values[1]) == abs(target)
+    elif operator == '/':
+        lo, hi = sorted(values)
+        return lo != 0 and hi % lo == 0 and hi // lo == abs(target)
+    else:
+        return values[0] == target
+
 
-    For every clique in cliques:
-        * Initialize the domain of each variable to contain every product
-        of the set [1...board-size] that are of length 'clique-size'.
+@lru_cache(maxsize=None)
+def clique_domain(size, members, operator, target):
+    """
+    Determine the domain of a single clique:
+        * Initialize the domain to contain every assignment
+        of the set [1...board-size] to its members.
         For example:
 
             board-size = 3 and clique-size = 2
 
-            products = [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (3, 1), (3, 2), (3, 3)]
+            candidates = [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (3, 1), (3, 2), (3, 3)]
 
         * Discard any value (assignment of the members of the clique) that:
         * is resulting in the members of the clique 'conflicting' with each other
         * does not 'satisfy' the given operation
+
+    For the commutative operations '+' and '*' only the sorted multisets of
+    values are enumerated (via combinations_with_replacement) and checked
+    against the target, and the few that 'satisfy' it are expanded into their
+    distinct orderings - up to factorial(clique-size) fewer checks than
+    enumerating every tuple. The candidates of the remaining operations are
+    laid out as a single (board-size ** clique-size, clique-size) numpy array.
+    Either way the row / column conflict check is evaluated as a vectorized
+    mask instead of per-tuple python calls
     """
-    domains = {}
-    for clique in cliques:
-        members, operator, target = clique
+    k = len(members)
+
+    if operator in '+*':
+        grid = np.array([ordering
+                         for values in combinations_with_replacement(range(1, size + 1), k)
+                         if satisfies(values, operator, target)
+                         for ordering in set(permutations(values))],
+                        dtype=np.int8).reshape(-1, k)
+        mask = np.ones(grid.shape[0], dtype=bool)
+    else:
+        grid = np.indices((size,) * k, dtype=np.int8).reshape(k, -1).T + 1
+
+        if operator == '-':
+            mask = np.abs(grid[:, 0] - grid[:, 1]) == abs(target)
+        elif operator == '/':
+            hi = np.maximum(grid[:, 0], grid[:, 1])
+            lo = np.minimum(grid[:, 0], grid[:, 1])
+            mask = (hi % lo == 0) & (hi // lo == abs(target))
+        else:
+            mask = grid[:, 0] == target
 
-        domains[members] = list(product(range(1, size + 1), repeat=len(members)))
+    pairs = [(i, j) for i, j in conflict_pairs(members, members) if i < j]
+    if pairs:
+        ii, jj = np.array(pairs, dtype=np.int8).T
+        mask &= (grid[:, ii] != grid[:, jj]).all(axis=1)
 
-        qualifies = lambda values: not conflicting(members, values, members, values) and satisfies(values,
-                                                                                                   operation(operator),
-                                                                                                   target)
+    domain = grid[mask]
+    domain.setflags(write=False)
 
-        domains[members] = list(filter(qualifies, domains[members]))
+    return domain
 
-    return domains
+
+def gdomains(size, cliques):
+    """
+    Determine the domain of each variable for the given puzzle, delegating
+    the per-clique work to the memoized 'clique_domain': benchmarking solves
+    every puzzle once per algorithm and identical cliques recur across
+    randomly generated puzzles, so repeated domains come straight from cache.
+
+    The cached domains stay as compact (n, clique-size) int8 arrays; only at
+    this boundary are they expanded into tuples of plain python ints, which
+    the CSP machinery needs as hashable assignment values
+    """
+    return {members: [tuple(values) for values in clique_domain(size, members, operator, target).tolist()]
+            for members, operator, target in cliques}
 
 
 
 def gneighbors(cliques):
     """
     Determine the neighbors of each variable for the given puzzle
-        For every clique in cliques
-        * Initialize its neighborhood as empty
-        * For every clique in cliques other than the clique at hand,
-            if they are probable to 'conflict' they are considered neighbors
+        * Register every clique into an inverted index keyed by the rows
+          and the columns its members occupy
+        * Two disjoint cliques can 'conflict' exactly when they share a row
+          or a column, so the neighborhood of a clique is the union of the
+          index entries for its own rows and columns
     """
+    by_row, by_col = {}, {}
+    for members, _, _ in cliques:
+        for x, y in members:
+            by_row.setdefault(y, set()).add(members)
+            by_col.setdefault(x, set()).add(members)
+
     neighbors = {}
     for members, _, _ in cliques:
-        neighbors[members] = []
+        nearby = set()
+        for x, y in members:
+            nearby |= by_row[y]
+            nearby |= by_col[x]
 
-    for A, _, _ in cliques:
-        for B, _, _ in cliques:
-            if A != B and B not in neighbors[A]:
-                if conflicting(A, [-1] * len(A), B, [-1] * len(B)):
-                    neighbors[A].append(B)
-                    neighbors[B].append(A)
+        nearby.discard(members)
+        neighbors[members] = list(nearby)
 
     return neighbors
 
@@ -301,10 +363,20 @@ class Kenken(csp.CSP):
             * <operation> is either addition, subtraction, division or multiplication
             * <target> is the value that the <operation> should produce
               when applied on the members of the clique
+
+        Internally the cliques are held as a structure of arrays: the member
+        tuples in one list and the operators and targets packed into parallel
+        numpy arrays, with the operators encoded through OPERATORS / OP_CODE
         """
         validate(size, cliques)
 
-        variables = [members for members, _, _ in cliques]
+        self.members_list = [members for members, _, _ in cliques]
+        self.ops = np.fromiter((OP_CODE[operator] for _, operator, _ in cliques),
+                               dtype=np.uint8, count=len(cliques))
+        self.targets = np.fromiter((target for _, _, target in cliques),
+                                   dtype=np.int32, count=len(cliques))
+
+        variables = self.members_list
 
         domains = gdomains(size, cliques)
 
@@ -318,12 +390,22 @@ class Kenken(csp.CSP):
         self.checks = 0
 
         # Used in displaying
-        self.padding = 0
-
-        self.meta = {}
-        for members, operator, target in cliques:
-            self.meta[members] = (operator, target)
-            self.padding = max(self.padding, len(str(target)))
+        self.padding = max((len(str(target)) for target in self.targets.tolist()), default=0)
+
+        self.cell_to_var = {}
+        for index, members in enumerate(self.members_list):
+            for member in members:
+                self.cell_to_var[member] = index
+
+        # One specialized checker compiled per neighboring pair of variables
+        # from its precomputed conflict indexes, so that at check time only
+        # the values that can actually collide are compared - no loop, no
+        # geometry and no lookups beyond fetching the checker itself
+        self._pair_fn = {}
+        for A in variables:
+            for B in neighbors[A]:
+                clauses = " and ".join("a[%d] != b[%d]" % pair for pair in conflict_pairs(A, B))
+                self._pair_fn[(A, B)] = eval("lambda a, b: " + clauses)
 
     def constraint(self, A, a, B, b):
         """
@@ -331,10 +413,18 @@ class Kenken(csp.CSP):
         or they are not 'conflicting' i.e. every member of variable A
         which shares the same row or column with a member of variable B
         must not have the same value assigned to it
+
+        Each neighboring pair of variables has a specialized checker compiled
+        for it up front, inlining the exact value comparisons the pair needs
         """
         self.checks += 1
 
-        return A == B or not conflicting(A, a, B, b)
+        if A == B:
+            return True
+
+        check = self._pair_fn.get((A, B))
+
+        return check is None or check(a, b)
 
     def display(self, assignment):
         """
@@ -363,12 +453,16 @@ class Kenken(csp.CSP):
         mentioned = set()
 
         def meta(member):
-            for var, val in self.meta.items():
-                if member in var and var not in mentioned:
-                    mentioned.add(var)
-                    return str(val[1]) + " " + (val[0] if val[0] != "." else " ")
+            index = self.cell_to_var[member]
+
+            if index in mentioned:
+                return ""
+
+            mentioned.add(index)
+
+            operator = OPERATORS[self.ops[index]]
 
-            return ""
+            return str(self.targets[index]) + " " + (operator if operator != "." else " ")
 
         fit = lambda word: padding(" ", len(word)) + word + padding(" ", 0)
 
@@ -435,6 +529,25 @@ def benchmark(kenken, algorithm):
     return assignment, (kenken.checks, kenken.nassigns, dt)
 
 
+def bench(task):
+    """
+    Worker of 'gather': benchmark a single (algorithm, puzzle) pair
+    in its own process and report the collected statistics
+    """
+    name, size, iteration, cliques = task
+
+    assignment, data = benchmark(Kenken(size, list(cliques)), algorithms[name])
+
+    return name, size, iteration, assignment is not None, data
+
+
+algorithms = {
+    "BT": lambda ken: csp.backtracking_search(ken),
+    "FC": lambda ken: csp.backtracking_search(ken, inference=csp.forward_checking),
+    "MAC": lambda ken: csp.backtracking_search(ken, inference=csp.mac),
+}
+
+
 def gather(iterations, start_size, end_size, out):
     """
     Benchmark each one of the following algorithms for various kenken puzzles
@@ -447,46 +560,36 @@ def gather(iterations, start_size, end_size, out):
            of the algorithm for the current size.
 
       * Save the results into a csv file
-    """
-    bt = lambda ken: csp.backtracking_search(ken)
-
-    fc = lambda ken: csp.backtracking_search(ken, inference=csp.forward_checking)
 
-    mac = lambda ken: csp.backtracking_search(ken, inference=csp.mac)
-
-    algorithms = {
-        "BT": bt,
-        "FC": fc,
-        "MAC": mac,
+    Every (algorithm, puzzle) pair is independent of the others, so the
+    evaluations are spread over a process pool with one worker per core
+    and only the csv writing happens on this process
+    """
+    tasks = []
+    for size in range(start_size, end_size + 1):
+        for iteration in range(1, iterations + 1):
+            _, cliques = generate(size)
 
-    }
+            for name in algorithms:
+                tasks.append((name, size, iteration, cliques))
 
-    with open(out, "w+") as file:
+    with ProcessPoolExecutor(max_workers=cpu_count()) as pool:
 
-        out = writer(file)
+        with open(out, "w+") as file:
 
-        out.writerow(
-            ["Algorithm  ", "Size  ", "Generation Number", "Constraint checks  ", "Assignments  ", "Completion time"])
-        counter = 0
-        for size in range(start_size, end_size + 1):
-            checks, assignments, dt = (0, 0, 0)
-            counter = 1
-            for iteration in range(1, iterations + 1):
-                size, cliques = generate(size)
+            out = writer(file)
 
-                for name, algorithm in algorithms.items():
-                    assignment, data = benchmark(Kenken(size, cliques), algorithm)
+            out.writerow(
+                ["Algorithm  ", "Size  ", "Generation Number", "Constraint checks  ", "Assignments  ", "Completion time"])
 
-                    print("algorithm =", name, "size =", size, "iteration =", iteration, "result =",
-                          "Success" if assignment else "Failure", file=stderr)
+            for name, size, iteration, solved, data in pool.map(bench, tasks):
+                print("algorithm =", name, "size =", size, "iteration =", iteration, "result =",
+                      "Success" if solved else "Failure", file=stderr)
 
-                    checks = data[0]
-                    assignments = data[1]
-                    dt = data[2]
+                checks, assignments, dt = data
 
-                    out.writerow([str(name) + "          ", str(size) + "          ", str(counter) + "       ",
-                                  str(checks) + "          ", str(assignments) + "         ", str(dt) + "          "])
-                counter = counter + 1
+                out.writerow([str(name) + "          ", str(size) + "          ", str(iteration) + "       ",
+                              str(checks) + "          ", str(assignments) + "         ", str(dt) + "          "])
 
 
 def kenken_input(board_size):
@@ -524,7 +627,4 @@ def generate_board(board_size):
 def solve(ken, algo):
     ken, assignment = getAssignment(ken, algo)
     output = ken.display(assignment)
-    start_size = 3
-    end_size = 4
-    gather(7, start_size, end_size, "out.csv")
     return output